@@ -0,0 +1,272 @@
+#!python
+'''
+   Copyright  2013  Gordon McGregor
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+
+
+  Checks for the parser entry points, using sample.vcd and a small fixture with
+  aliased and bit-blasted signals. Run directly, or with a test runner.
+
+'''
+
+from StringIO import StringIO
+import shutil
+import tempfile
+import os
+
+from vcd import parser, watcher
+
+
+FIXTURE = '''$timescale 1ns $end
+$scope module top $end
+$var wire 8 ! bus [8:1] $end
+$var wire 1 # addr [0] $end
+$var wire 1 $ addr [1] $end
+$scope module sub $end
+$var wire 8 ! y [7:0] $end
+$upscope $end
+$upscope $end
+$enddefinitions $end #0
+b0 !
+0#
+1$
+#10
+b10 !
+#20
+b11 !
+#30
+b1000011 !
+'''
+
+
+def header(text=FIXTURE):
+	vcd = parser.VcdParser()
+	fh = StringIO(text)
+	vcd.parse_header(fh)
+	return vcd, fh
+
+
+def test_header_only():
+	vcd = parser.VcdParser()
+	with open('sample.vcd') as fh:
+		vcd.parse_header(fh)
+		assert fh.read(20).split()[0] == '#500'
+
+	assert vcd.date == 'June 26, 1989 10:05:41'
+	assert vcd.timescale == '1 ns'
+	assert vcd.end_time is None and vcd.value_changes is None
+
+	(root_type, scopes, vars) = vcd.scope_tree
+	(top_type, top_scopes, top_vars) = scopes['top']
+	assert sorted(top_scopes) == ['m1', 't1']
+	assert top_scopes['t1'][0] == 'task'
+	assert top_scopes['t1'][2][0] == ('accumulator', 'reg', '32', '(k', '[31:0]')
+
+
+def test_body_on_header_line():
+	vcd, fh = header()
+	vcd.parse(fh)
+	assert vcd.now == '30'
+	assert vcd.changes['!'] == ('b', '1000011')
+
+
+def test_index():
+	handle, filename = tempfile.mkstemp(suffix='.vcd')
+	os.close(handle)
+	shutil.copy('sample.vcd', filename)
+	try:
+		with open(filename, 'r+') as fh:
+			vcd = parser.VcdParser()
+			vcd.parse_header(fh)
+			vcd.write_index(fh)
+
+		with open(filename) as fh:
+			vcd = parser.VcdParser()
+			vcd.parse_header(fh)
+			assert (vcd.end_time, vcd.value_changes) == (2010, 31)
+			vcd.parse(fh)
+			assert vcd.now == '2010'
+	finally:
+		os.remove(filename)
+
+
+def test_aliases_and_selects():
+	vcd, fh = header()
+
+	# top.bus is declared [8:1] and top.sub.y [7:0] on the same id code
+	assert vcd.get_id('top.bus') == vcd.get_id('top.sub.y') == '!'
+	assert vcd.get_id('top.sub.y[0]') == vcd.get_id('top.bus[1]') == ('!', 0, 1)
+	assert vcd.get_id('top.sub.y[7]') == vcd.get_id('top.bus[8]') == ('!', 7, 1)
+	assert vcd.get_id('top.bus[4:1]') == ('!', 0, 15)
+	assert vcd.get_id('top.bus[8:1]') == '!'
+	assert len(vcd.selects['!']) == 3
+
+	for xmr in ('top.bus[0]', 'top.sub.y[8]', 'top.missing', 'top.missing[0]'):
+		try:
+			vcd.get_id(xmr)
+			assert False, xmr
+		except ValueError:
+			pass
+
+
+def test_bit_blasted():
+	vcd, fh = header()
+	assert vcd.get_id('top.addr[0]') == '#'
+	assert vcd.get_id('top.addr[1]') == '$'
+	assert vcd.get_aliases('#') == ['top.addr[0]']
+
+	for xmr in ('top.addr', 'top.addr[1:0]'):
+		try:
+			vcd.get_id(xmr)
+			assert False, xmr
+		except ValueError:
+			pass
+
+
+class SelectWatcher(watcher.VcdWatcher):
+
+	def __init__(self):
+		self.sensitive = []
+		self.watching = []
+		self.seen = []
+		self.set_hierarchy('top')
+		self.add_sensitive('sub.y[0]')
+		self.add_sensitive('bus[2]')
+
+	def update(self):
+		self.seen.append((self.parser.now, dict((self.parser.get_xmr(id), value) for id, value in self.activity.items())))
+
+
+def test_select_notifications():
+	vcd = parser.VcdParser()
+	select_watcher = SelectWatcher()
+	vcd.register_watcher(select_watcher)
+	vcd.parse(StringIO(FIXTURE))
+	vcd.update_time('40')
+
+	# notified only when the selected bits change, not on every write to the bus
+	assert select_watcher.seen == [
+		('0', {'top.sub.y[0]': '0', 'top.bus[2]': '0'}),
+		('10', {'top.bus[2]': '1'}),
+		('20', {'top.sub.y[0]': '1'}),
+	]
+
+
+def test_select_values():
+	vcd = parser.VcdParser()
+	assert vcd.format_bits(vcd.vector_bits(('b', '10110'), 8), 255) == ('b', '00010110')
+	assert vcd.format_bits(vcd.vector_bits(('b', 'x10z'), 8), 255) == ('b', 'xxxxx10z')
+	assert vcd.format_bits(vcd.vector_bits(('b', 'z1'), 4), 15) == ('b', 'zzz1')
+	assert vcd.format_bits((0, 1, 0), 1) == 'x'
+
+
+def test_real_selects():
+	text = '''$scope module top $end
+$var realtime 64 % rt $end
+$var real 64 & r $end
+$enddefinitions $end
+#0
+r1.5 %
+r2.5 &
+'''
+	vcd, fh = header(text)
+	for xmr in ('top.rt[3:0]', 'top.r[0]'):
+		try:
+			vcd.get_id(xmr)
+			assert False, xmr
+		except ValueError:
+			pass
+
+	# a select registered against a real value change is left alone
+	vcd.selects['%'].append((('%', 0, 15), 0, 15))
+	vcd.parse(fh)
+	assert vcd.changes['%'] == ('r', '1.5')
+	vcd.update_selects()
+	assert ('%', 0, 15) not in vcd.changes
+
+
+def replay(text, time):
+	'''Signal values at a time, by a straight walk through the body for comparison'''
+	vcd, fh = header(text)
+	state = {}
+	for change in vcd.body_changes(fh):
+		if change[0] is None:
+			if change[1] > time:
+				break
+		else:
+			state[change[0]] = change[1]
+	return dict((xmr, state.get(id, 'x')) for id in vcd.idcode2references for xmr in vcd.get_aliases(id))
+
+
+def test_state_at():
+	sample = open('sample.vcd').read()
+	for text in (sample, FIXTURE):
+		for (interval, budget) in ((1, 1000000), (1, 60), (3, 1), (100000, 1000000)):
+			vcd = parser.VcdParser()
+			vcd.build_snapshots(StringIO(text), interval=interval, memory_budget=budget)
+			for time in (0, 5, 10, 25, 30, 500, 505, 512, 535, 1000, 1999, 2000, 2010, 3000, 25, 512):
+				assert vcd.state_at(time) == replay(text, time), (interval, budget, time)
+
+
+def test_state_at_signals():
+	vcd = parser.VcdParser()
+	vcd.build_snapshots(StringIO(FIXTURE), interval=1)
+	assert vcd.state_at(10, 'top.sub') == {'top.sub.y': ('b', '10')}
+	assert vcd.state_at(10, ['top.addr[0]', 'top.addr[1]']) == {'top.addr[0]': '0', 'top.addr[1]': '1'}
+	assert sorted(vcd.state_at(10, 'top')) == ['top.addr[0]', 'top.addr[1]', 'top.bus', 'top.sub.y']
+
+	# any iterable of names, used once
+	assert vcd.state_at(25, (xmr for xmr in ['top.bus'])) == {'top.bus': ('b', '11')}
+	assert vcd.state_at(25, ['top.bus']) == {'top.bus': ('b', '11')}
+
+	for signals in ('top.missing', 'top.bus[3:0]', 'top.addr', (xmr for xmr in ['top.missing'])):
+		try:
+			vcd.state_at(10, signals)
+			assert False, signals
+		except ValueError:
+			pass
+
+
+def test_snapshots_after_parse():
+	vcd = parser.VcdParser()
+	try:
+		vcd.state_at(10)
+		assert False
+	except ValueError:
+		pass
+
+	vcd.parse(StringIO(FIXTURE))
+	vcd.build_snapshots(StringIO(FIXTURE), interval=1)
+	assert vcd.state_at(30, 'top.bus') == {'top.bus': ('b', '1000011')}
+
+	# header read through one handle, snapshots through another
+	vcd, fh = header()
+	vcd.build_snapshots(StringIO('$comment $enddefinitions $end\n' + FIXTURE), interval=1)
+	assert vcd.state_at(20, 'top.bus') == {'top.bus': ('b', '11')}
+
+	# the handle parse_header read is not scanned a second time
+	vcd, fh = header()
+	def rescan(file_handle):
+		assert False, 'header scanned twice'
+	vcd.find_body_offset = rescan
+	vcd.build_snapshots(fh, interval=1)
+	assert vcd.state_at(20, 'top.bus') == {'top.bus': ('b', '11')}
+
+
+if __name__ == '__main__':
+	for name, test in sorted(globals().items()):
+		if name.startswith('test_'):
+			test()
+			print name, 'ok'
@@ -32,9 +32,22 @@
 
 from itertools import dropwhile, takewhile, izip
 from collections import defaultdict
+from bisect import bisect_left, bisect_right
+from string import maketrans
 import sys
+import re
 
 from watcher import VcdWatcher
+from snapshot import VcdSnapshotCache
+
+# Translation tables to split a binary vector value into value, x and z bit masks
+VALUE_BITS = maketrans('xXzZ', '0000')
+X_BITS = maketrans('1xXzZ', '01100')
+Z_BITS = maketrans('1xXzZ', '00011')
+
+REAL_TYPES = ('real', 'realtime')
+
+SELECT = re.compile(r'^(.*)\[(\d+)(?::(\d+))?\]$')
 
 class VcdParser(object):
   ''' A parser object for VCD files.  Reads definitions and walks through the value changes'''
@@ -62,10 +75,16 @@ class VcdParser(object):
     self.keyword_dispatch = defaultdict(self.parse_error, keyword_functions)
  
     self.scope = []
+    self.scope_tree = ('root', {}, [])
+    self.scope_nodes = [self.scope_tree]
     self.now = 0
     self.then = 0
     self.idcode2references = defaultdict(list)
+    self.xmr2id = dict()
+    self.ambiguous = set()
     self.xmr_cache = dict()
+    self.selects = defaultdict(list)
+    self.select_state = dict()
     self.end_of_definitions = False
     self.changes = {}
     self.watchers = []
@@ -73,31 +92,87 @@ class VcdParser(object):
 
     self.watched_changes = {}
 
+    self.body_offset = None
+    self.header_file = None
+    self.end_time = None
+    self.value_changes = None
 
-  def get_id(self, xmr):
-    '''Given a Cross Module Reference (XMR) find the associated VCD ID string'''
-    search_path = xmr.split('.')
+    self.snapshot_file = None
+    self.snapshot_cache = None
+    self.snapshot_times = []
+    self.snapshot_offsets = []
+    self.last_state = None
+    self.signal_names = None
+    self.signal_matches = {}
 
-    for id in self.idcode2references:
-      (var_type, size, reference) = self.idcode2references[id][0]
-      match = True  
-      for depth, node in enumerate(search_path):
-        var_type, name = reference[depth]
-        if node == name:
-          continue
-        else:
-          match = False
-          break
-      if match:
-        return id
 
-    raise ValueError('No match for ', xmr)
+  def get_id(self, xmr):
+    '''Given a Cross Module Reference (XMR) find the associated VCD ID string. Any alias of a
+       signal may be used. A bit or part select, e.g. top.addr[7:4], returns a select key
+       (id, shift, mask) that is tracked like an id, changing only when the selected bits do'''
+    if xmr in self.xmr2id:
+      return self.xmr2id[xmr][0]
+
+    match = SELECT.match(xmr)
+    base = match.group(1) if match else xmr
+    if base in self.ambiguous:
+      raise ValueError('Ambiguous reference, give the declared range ', xmr)
+    if not match or base not in self.xmr2id:
+      raise ValueError('No match for ', xmr)
+
+    # the declared range comes from the alias named, as aliases may declare different ranges
+    (id, bit_range) = self.xmr2id[base]
+    (var_type, size, reference, declared) = self.idcode2references[id][0]
+    size = int(size)
+    if var_type in REAL_TYPES:
+      raise ValueError('Cannot select bits of a real ', xmr)
+
+    (msb, lsb) = self.parse_range(bit_range, size)
+    left = int(match.group(2))
+    right = int(match.group(3) or left)
+    for index in (left, right):
+      if not min(msb, lsb) <= index <= max(msb, lsb):
+        raise ValueError('Select out of range ', xmr)
+
+    # bit positions counted from the right hand end of the value string
+    (left_pos, right_pos) = (abs(left - lsb), abs(right - lsb))
+    width = abs(left_pos - right_pos) + 1
+    if width == size:
+      return id
+
+    (shift, mask) = (min(left_pos, right_pos), (1 << width) - 1)
+    key = (id, shift, mask)
+    if (key, shift, mask) not in self.selects[id]:
+      self.selects[id].append((key, shift, mask))
+      self.xmr_cache[key] = xmr
+    return key
+
+
+  def parse_range(self, bit_range, size):
+    '''Convert a declared range such as [31:0] or [3] to (msb, lsb), defaulting to [size-1:0]'''
+    if not bit_range:
+      return (size - 1, 0)
+    bounds = bit_range.strip('[]').split(':')
+    return (int(bounds[0]), int(bounds[-1]))
 
 
   def show_nets(self):
     '''Dump all the XMR/ hierarchical paths in the VCD file'''
     for id in self.idcode2references:
-      print self.get_xmr(id)
+      for xmr in self.get_aliases(id):
+        print xmr
+
+
+  def get_aliases(self, id):
+    '''All the hierarchical references that share an ID. The declared range is included
+       where the name alone is ambiguous, as in a bit-blasted bus'''
+    aliases = []
+    for (type, size, refs, bit_range) in self.idcode2references[id]:
+      xmr = ".".join([ v for (k, v) in refs])
+      if xmr in self.ambiguous and bit_range:
+        xmr += bit_range
+      aliases.append(xmr)
+    return aliases
 
 
   def get_xmr(self, id):
@@ -105,8 +180,7 @@ class VcdParser(object):
     if id in self.xmr_cache:
       return self.xmr_cache[id]
 
-    (type, size, refs) = self.idcode2references[id][0]
-    xmr = ".".join([ v for (k, v) in refs])
+    xmr = self.get_aliases(id)[0]
     self.xmr_cache[id] = xmr
     return xmr
 
@@ -137,6 +211,9 @@ class VcdParser(object):
      and update any watchers that are sensitive to a signal that has changed'''
     current_time = self.now
 
+    if self.selects:
+      self.update_selects()
+
     if self.debug: 
       print "Current time is ", self.now, 'changing to ', next_time
       for change in self.changes:
@@ -164,6 +241,68 @@ class VcdParser(object):
     self.now = next_time
 
 
+  def update_selects(self):
+    '''Add changes for bit/ part selects to the collected changes, but only where the
+       selected bits differ from their previous value'''
+    # walk whichever of the selected buses and the changed ids is shorter
+    if len(self.selects) < len(self.changes):
+      ids = [id for id in self.selects if id in self.changes]
+    else:
+      ids = [id for id in self.changes if id in self.selects]
+
+    for id in ids:
+      if self.changes[id][0] == 'r':
+        continue
+      vector = self.vector_bits(self.changes[id], int(self.idcode2references[id][0][1]))
+      for (key, shift, mask) in self.selects[id]:
+        value = tuple((bits >> shift) & mask for bits in vector)
+        if self.select_state.get(key) != value:
+          self.select_state[key] = value
+          self.changes[key] = self.format_bits(value, mask)
+
+
+  def vector_bits(self, value, size):
+    '''Split a vector value into integer (value, x, z) bit masks, left extending as per the VCD rules'''
+    (format, number) = value
+    if not number.translate(None, '01'):
+      return (int(number, 2), 0, 0)
+
+    length = len(number)
+    bits = int(number.translate(VALUE_BITS), 2)
+    x = int(number.translate(X_BITS), 2)
+    z = int(number.translate(Z_BITS), 2)
+
+    if size > length:
+      extension = ((1 << size) - 1) ^ ((1 << length) - 1)
+      if number[0] in 'xX':
+        x |= extension
+      elif number[0] in 'zZ':
+        z |= extension
+
+    return (bits, x, z)
+
+
+  def format_bits(self, value, mask):
+    '''Build a watcher value from selected bits - a scalar for a single bit, otherwise a binary vector'''
+    (bits, x, z) = value
+    width = mask.bit_length()
+    digits = bin(bits)[2:].zfill(width)
+
+    # only unknown bits need visiting one at a time
+    unknown = x | z
+    if unknown:
+      digits = list(digits)
+      while unknown:
+        bit = unknown & -unknown
+        digits[width - bit.bit_length()] = 'x' if x & bit else 'z'
+        unknown ^= bit
+      digits = ''.join(digits)
+
+    if width == 1:
+      return digits
+    return ('b', digits)
+
+
   def update_watched_changes(self):
     '''Watched changes is a persistent store of changes to the list of signals considered by all watchers. Here it is updated 
        after any watcher updates from update_time, to store the 'new' values'''
@@ -176,6 +315,102 @@ class VcdParser(object):
     self.extract(file_handle)
 
 
+  def parse_header(self, file_handle):
+    '''Read only the definitions, up to $enddefinitions, leaving the file positioned at the
+       start of the value changes. Signals, date, version and timescale are available
+       afterwards, along with scope_tree, and parse can be called on the same handle to
+       continue through the body.
+
+       scope_tree is the root scope node. Each node is a (scope_type, scopes, vars) tuple,
+       where scopes maps a child scope name to its node and vars is a list of
+       (name, var_type, size, identifier_code, bit_range) tuples in declaration order'''
+    try:
+      offset = file_handle.tell()
+    except (AttributeError, IOError):
+      offset = None
+
+    self.header_file = file_handle
+    tokeniser = self.header_tokens(file_handle, offset)
+    for token in tokeniser:
+      self.keyword_dispatch[token](tokeniser, token)
+      if self.end_of_definitions:
+        break
+
+    if self.body_offset is not None:
+      file_handle.seek(self.body_offset)
+    self.read_index(file_handle)
+
+
+  def header_tokens(self, fh, offset=None):
+    '''Token generator for the definitions. readline avoids the file iterator read-ahead, so only
+       the header is pulled from disk, and when the start offset is known body_offset is kept
+       just past the last token handed out - value changes may follow $enddefinitions on one line'''
+    for line in iter(fh.readline, ''):
+      for match in re.finditer(r'\S+', line):
+        if offset is not None:
+          self.body_offset = offset + match.end()
+        yield match.group()
+      if offset is not None:
+        offset += len(line)
+
+
+  def read_index(self, file_handle, tail_size=4096):
+    '''Look for an optional trailing index comment at the end of the dump, of the form
+
+         $comment vcd_index end_time <time> value_changes <count> $end
+
+       as appended by write_index, and use it to set end_time and value_changes without
+       scanning the body'''
+    if self.body_offset is None:
+      return
+
+    try:
+      file_handle.seek(0, 2)
+      size = file_handle.tell()
+      file_handle.seek(max(self.body_offset, size - tail_size))
+      tail = file_handle.read()
+      file_handle.seek(self.body_offset)
+    except (AttributeError, IOError):
+      return
+
+    start = tail.rfind('$comment')
+    if start < 0:
+      return
+
+    words = tail[start:].split()
+    if len(words) != 7 or words[1] != 'vcd_index' or words[6] != '$end':
+      return
+
+    fields = dict(zip(words[2:6:2], words[3:6:2]))
+    if 'end_time' in fields and 'value_changes' in fields:
+      self.end_time = int(fields['end_time'])
+      self.value_changes = int(fields['value_changes'])
+
+
+  def write_index(self, file_handle):
+    '''Scan the body once and append the trailing index comment read by read_index, so later
+       header only reads know the end time and number of value changes. The file must be
+       opened for update ('r+') and parse_header called on it first'''
+    if self.body_offset is None:
+      raise ValueError('parse_header must be called before write_index')
+
+    file_handle.seek(self.body_offset)
+    end_time = 0
+    value_changes = 0
+    for change in self.body_changes(file_handle):
+      if change[0] is None:
+        end_time = change[1]
+      else:
+        value_changes += 1
+
+    file_handle.seek(0, 2)
+    file_handle.write('\n$comment vcd_index end_time %d value_changes %d $end\n' % (end_time, value_changes))
+    file_handle.seek(self.body_offset)
+
+    self.end_time = end_time
+    self.value_changes = value_changes
+
+
   def extract(self, fh):
     '''Tokenize and parse the VCD file'''
     # open the VCD file and create a token generator
@@ -188,7 +423,10 @@ class VcdParser(object):
       else:
         # Working through changes
         c, rest = token[0], token[1:]
-        if c == '$':
+        if token == '$comment':
+          # comments may appear in the sim section, including a trailing index
+          self.drop_declaration(tokeniser, token)
+        elif c == '$':
           # skip $dump* tokens and $end tokens in sim section
           continue
         elif c == '#':
@@ -201,6 +439,194 @@ class VcdParser(object):
           raise "Don't understand: %s After %i words" % (token, count)
 
 
+  def body_tokens(self, fh):
+    '''Token generator for the value change section, yielding (line offset, token) pairs'''
+    while True:
+      offset = fh.tell()
+      line = fh.readline()
+      if not line:
+        return
+      for word in line.split():
+        yield offset, word
+
+
+  def body_changes(self, fh):
+    '''Walk the value change section from the current file position, yielding
+       (None, time, offset) at each time marker and (id, value) for each change'''
+    tokeniser = self.body_tokens(fh)
+    for offset, token in tokeniser:
+      c, rest = token[0], token[1:]
+      if token == '$comment':
+        dropwhile(lambda x: x[1] != "$end", tokeniser).next()
+      elif c == '$':
+        continue
+      elif c == '#':
+        yield None, int(rest), offset
+      elif c in '01xXzZ':
+        yield rest, c
+      elif c in 'bBrR':
+        yield tokeniser.next()[1], (c.lower(), rest)
+      else:
+        raise ValueError("Don't understand: %s" % token)
+
+
+  def build_snapshots(self, file_handle, interval=100000, memory_budget=64 * 1024 * 1024):
+    '''First pass over the dump for state_at queries. Records a full state snapshot at the
+       first time marker after every interval value changes, so a query only replays from
+       the nearest earlier snapshot. Snapshots are kept compressed in an LRU cache limited
+       to memory_budget bytes. The file handle must be seekable and is kept open for later queries'''
+    if not self.end_of_definitions:
+      self.parse_header(file_handle)
+    elif file_handle is not self.header_file:
+      self.find_body_offset(file_handle)
+
+    if self.body_offset is None:
+      raise ValueError('build_snapshots needs a seekable file')
+
+    self.signal_names = sorted((xmr, id) for id in self.idcode2references for xmr in self.get_aliases(id))
+    self.signal_matches = {}
+
+    self.snapshot_file = file_handle
+    self.snapshot_cache = VcdSnapshotCache(sorted(self.idcode2references), memory_budget)
+    self.snapshot_times = []
+    self.snapshot_offsets = []
+    self.last_state = None
+
+    file_handle.seek(self.body_offset)
+    state = {}
+    count = 0
+    for change in self.body_changes(file_handle):
+      if change[0] is None:
+        if count >= interval:
+          # snapshot holds the state just before the changes at this time marker
+          (marker, time, offset) = change
+          self.snapshot_cache.put(len(self.snapshot_times), state)
+          self.snapshot_times.append(time)
+          self.snapshot_offsets.append(offset)
+          count = 0
+      else:
+        state[change[0]] = change[1]
+        count += 1
+
+
+  def state_at(self, time, signals=None):
+    '''Return the value of each signal at the given time, as a dictionary of XMR to value.
+       signals is an optional list of XMRs or hierarchy prefixes to restrict the result to.
+       build_snapshots must be called first'''
+    if self.snapshot_file is None:
+      raise ValueError('build_snapshots must be called before state_at')
+
+    time = int(time)
+    signals = self.match_signals(signals)
+
+    # A repeated query within the same time step needs no replay at all
+    if self.last_state:
+      (applied, stop_time, stop_offset, state) = self.last_state
+      if applied <= time and (stop_time is None or time < stop_time):
+        return dict((xmr, state.get(id, 'x')) for (xmr, id) in signals)
+
+    # Start from the nearest earlier snapshot that is still cached, or the body start
+    index = bisect_right(self.snapshot_times, time) - 1
+    while index >= 0 and index not in self.snapshot_cache:
+      index -= 1
+
+    if index >= 0:
+      start_time, offset = self.snapshot_times[index], self.snapshot_offsets[index]
+      state = self.snapshot_cache.get(index)
+    else:
+      start_time, offset, state = None, self.body_offset, {}
+
+    # Resuming from the end of the previous query may be closer
+    if self.last_state:
+      (applied, stop_time, stop_offset, last) = self.last_state
+      if stop_time is not None and stop_time <= time and (start_time is None or stop_time > start_time):
+        start_time, offset, state = stop_time, stop_offset, dict(last)
+
+    # Replay up to the requested time, restoring any evicted snapshots passed on the way
+    fh = self.snapshot_file
+    fh.seek(offset)
+    applied = 0
+    stop_time, stop_offset = None, None
+    for change in self.body_changes(fh):
+      if change[0] is None:
+        (marker, change_time, change_offset) = change
+        if change_time > time:
+          stop_time, stop_offset = change_time, change_offset
+          break
+        index = bisect_right(self.snapshot_times, change_time) - 1
+        if index >= 0 and self.snapshot_times[index] == change_time and index not in self.snapshot_cache:
+          self.snapshot_cache.put(index, state)
+        applied = change_time
+      else:
+        state[change[0]] = change[1]
+
+    self.last_state = (applied, stop_time, stop_offset, state)
+    return dict((xmr, state.get(id, 'x')) for (xmr, id) in signals)
+
+
+  def match_signals(self, signals=None):
+    '''Find (XMR, id) pairs for every alias matching a list of XMRs or hierarchy prefixes, using
+       the sorted signal names from build_snapshots. Results are cached for all signals and for
+       single XMR or prefix queries'''
+    cacheable = signals is None or isinstance(signals, basestring)
+    if cacheable and signals in self.signal_matches:
+      return self.signal_matches[signals]
+
+    key = signals
+    if isinstance(signals, basestring):
+      signals = (signals,)
+    elif signals is not None:
+      signals = tuple(signals)
+
+    names = self.signal_names
+    if signals is None:
+      matches = list(names)
+    else:
+      matches = []
+      seen = set()
+      for signal in signals:
+        if signal in self.xmr2id:
+          found = [(signal, self.xmr2id[signal][0])]
+        else:
+          # everything below a hierarchy prefix is one contiguous run of the sorted names
+          prefix = signal + '.'
+          start = end = bisect_left(names, (prefix,))
+          while end < len(names) and names[end][0].startswith(prefix):
+            end += 1
+          found = names[start:end]
+        if not found:
+          raise ValueError('No match for ', signal)
+        for match in found:
+          if match not in seen:
+            seen.add(match)
+            matches.append(match)
+
+    if cacheable:
+      self.signal_matches[key] = matches
+    return matches
+
+
+  def find_body_offset(self, file_handle):
+    '''Locate the start of the value changes in a file whose header has already been read,
+       possibly through another handle'''
+    self.body_offset = None
+    try:
+      file_handle.seek(0)
+    except (AttributeError, IOError):
+      return
+
+    tokeniser = self.header_tokens(file_handle, 0)
+    for token in tokeniser:
+      if token == '$comment':
+        self.drop_declaration(tokeniser, token)
+      elif token == '$enddefinitions':
+        self.drop_declaration(tokeniser, token)
+        self.header_file = file_handle
+        return
+
+    raise ValueError('No $enddefinitions in file')
+
+
   def parse_error(self, tokeniser, keyword):
     raise "Don't understand keyword: " + keyword
 
@@ -225,19 +651,47 @@ class VcdParser(object):
     
 
   def vcd_scope(self, tokeniser, keyword):
-    self.scope.append( tuple(takewhile(lambda x: x != "$end", tokeniser)))
+    (scope_type, name) = tuple(takewhile(lambda x: x != "$end", tokeniser))
+    self.scope.append((scope_type, name))
+
+    # scope_tree nodes are (scope_type, child scopes by name, vars) tuples
+    node = self.scope_nodes[-1][1].setdefault(name, (scope_type, {}, []))
+    self.scope_nodes.append(node)
     
     
   def vcd_upscope(self, tokeniser, keyword):
     self.scope.pop()
+    self.scope_nodes.pop()
     tokeniser.next()
     
     
   def vcd_var(self, tokeniser, keyword):
     data = tuple(takewhile(lambda x: x != "$end", tokeniser))
-    (var_type, size, identifier_code, reference) = data[:4] # ignore range on identifier ( TODO  Fix this )
+    (var_type, size, identifier_code, reference) = data[:4]
+
+    # the range is either a separate token or appended to the reference, e.g. addr[7:0]
+    if len(data) > 4:
+      bit_range = data[4]
+    elif '[' in reference:
+      reference, bit_range = reference[:reference.index('[')], reference[reference.index('['):]
+    else:
+      bit_range = None
+
+    self.scope_nodes[-1][2].append((reference, var_type, size, identifier_code, bit_range))
+
     reference = self.scope + [('var', reference)]
-    self.idcode2references[identifier_code].append( (var_type, size, reference))
+    self.idcode2references[identifier_code].append( (var_type, size, reference, bit_range))
+
+    # the bare name is only kept while it refers to one declaration, bit-blasted buses
+    # declare several signals with the same name and must be named with their range
+    xmr = ".".join([ v for (k, v) in reference])
+    if bit_range:
+      self.xmr2id[xmr + bit_range] = (identifier_code, bit_range)
+    if xmr in self.xmr2id and self.xmr2id[xmr] != (identifier_code, bit_range):
+      del self.xmr2id[xmr]
+      self.ambiguous.add(xmr)
+    elif xmr not in self.ambiguous:
+      self.xmr2id[xmr] = (identifier_code, bit_range)
     
     
   def vcd_dumpall(self, tokeniser, keyword): 
@@ -266,6 +720,14 @@ if __name__ == '__main__':
 
   vcd = VcdParser()
 
+  filename = [arg for arg in sys.argv[1:] if not arg.startswith('-')][0]
+
+  if '--nets' in sys.argv:
+    with open(filename) as vcd_file:
+      vcd.parse_header(vcd_file)
+    vcd.show_nets()
+    sys.exit(0)
+
   watcher = VcdWatcher()
   watcher.set_hierarchy('top.m1')
   watcher.add_sensitive('net3')
@@ -275,5 +737,5 @@ if __name__ == '__main__':
 
   vcd.register_watcher(watcher)
 
-  with open(sys.argv[1]) as vcd_file:
+  with open(filename) as vcd_file:
     vcd.parse(vcd_file)
@@ -0,0 +1,84 @@
+'''
+   Copyright  2013  Gordon McGregor
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+
+VcdSnapshotCache holds compressed full-state snapshots of a VCD dump.
+
+Each snapshot is the value of every signal at a point in the dump, encoded in a
+fixed id order and zlib compressed. The cache is least recently used, with a memory
+budget in bytes - the parser rebuilds any evicted snapshot by replaying from an
+earlier one when it is next needed.
+
+'''
+
+from collections import OrderedDict
+import zlib
+
+
+class VcdSnapshotCache(object):
+	'''LRU store of compressed signal state, bounded by total compressed size'''
+
+	def __init__(self, ids, memory_budget):
+		self.ids = ids
+		self.memory_budget = memory_budget
+		self.size = 0
+		self.snapshots = OrderedDict()
+
+
+	def encode(self, state):
+		'''Pack a state dictionary (id -> value) into a compressed string'''
+		values = []
+		for id in self.ids:
+			value = state.get(id, 'x')
+			if isinstance(value, tuple):
+				value = ''.join(value)
+			values.append(value)
+		return zlib.compress('\n'.join(values))
+
+
+	def decode(self, data):
+		'''Unpack a compressed string back into a state dictionary'''
+		state = {}
+		for id, value in zip(self.ids, zlib.decompress(data).split('\n')):
+			if len(value) > 1:
+				value = (value[0], value[1:])
+			state[id] = value
+		return state
+
+
+	def get(self, key):
+		'''Return the state stored under key, or None if it has been evicted'''
+		data = self.snapshots.pop(key, None)
+		if data is None:
+			return None
+		self.snapshots[key] = data
+		return self.decode(data)
+
+
+	def put(self, key, state):
+		'''Store a state, evicting the least recently used entries to stay within budget'''
+		data = self.encode(state)
+		if key in self.snapshots:
+			self.size -= len(self.snapshots.pop(key))
+		self.snapshots[key] = data
+		self.size += len(data)
+
+		while self.size > self.memory_budget and len(self.snapshots) > 1:
+			(old_key, old_data) = self.snapshots.popitem(last=False)
+			self.size -= len(old_data)
+
+
+	def __contains__(self, key):
+		return key in self.snapshots